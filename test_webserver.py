@@ -0,0 +1,148 @@
+import asyncio
+import time
+
+import pytest
+
+import webserver
+
+
+class FakeDouYu:
+    def __init__(self, rid):
+        self.rid = rid
+
+    def get_real_url(self):
+        return {'flv': 'http://example.com/live/{}.flv'.format(self.rid)}
+
+
+@pytest.fixture(autouse=True)
+def server(monkeypatch):
+    monkeypatch.setattr(webserver, 'DouYu', FakeDouYu)
+    monkeypatch.setattr(webserver, 'auto_refresh_interval', 7200)
+    monkeypatch.setattr(webserver, 'processor_maps', {})
+    log = webserver.Logger()
+    monkeypatch.setattr(webserver, 'log', log)
+    yield
+    log.stop()
+    log.logger.handlers.clear()
+
+
+async def _serve(*requests):
+    loop = asyncio.get_running_loop()
+    await webserver.setup_app_ctx(webserver.app, loop)
+    try:
+        rsps = [await webserver.serviceWithRate(None, *r) for r in requests]
+        # let the refresh scheduled from the executor thread land on the loop
+        await asyncio.sleep(0.1)
+        return rsps, dict(webserver.app.ctx.scheduler)
+    finally:
+        await webserver.close_app_ctx(webserver.app, loop)
+
+
+def test_cold_request_with_auto_refresh():
+    (rsp,), scheduler = asyncio.run(_serve(('douyu', '1', None)))
+    assert rsp.status == 301
+    assert rsp.headers['Location'] == 'http://example.com/live/1.flv'
+    assert len(scheduler) == 1
+
+
+def test_unknown_provider():
+    (rsp,), _ = asyncio.run(_serve(('nope', '1', None)))
+    assert rsp.status == 404
+
+
+class FakeHuYa:
+    room = '2'
+    cdn_index = 0
+
+
+class FailingHttp:
+    def get(self, url):
+        raise OSError('unreachable')
+
+
+def test_fallback_playlist_is_not_cached(monkeypatch):
+    monkeypatch.setattr(webserver, '_M3U8_CACHE', {})
+    request = type('Request', (), {})()
+    request.app = type('App', (), {})()
+    request.app.ctx = type('Ctx', (), {'http': FailingHttp()})()
+    key = ('2', 0, None)
+    status_code, m3u8_content = asyncio.run(webserver._get_m3u8(request, FakeHuYa(), 'http://example.com/2.m3u8', key))
+    assert status_code == 200
+    assert m3u8_content.endswith(b'http://example.com/2.m3u8')
+    assert key not in webserver._M3U8_CACHE
+
+
+def test_refresh_backoff_is_capped():
+    extractor = webserver.DouYuRealUrlExtractor('1', 7200)
+    assert extractor._refresh_interval(False) == 7200
+    intervals = []
+    for streak in (1, 2, 3, 4, 5, 6, 1030):
+        extractor._fail_streak = streak
+        intervals.append(extractor._refresh_interval(True))
+    assert intervals == [3600, 7200, 14400, 28800, 57600, 86400, 86400]
+
+
+class DeadRoom:
+    scrapes = 0
+
+    def __init__(self, rid):
+        DeadRoom.scrapes += 1
+        raise Exception('房间未开播')
+
+
+@pytest.mark.parametrize('provider, scraper', [('douyu', 'DouYu'), ('bilibili', 'BiliBili')])
+def test_dead_room_is_not_scraped_per_request(monkeypatch, provider, scraper):
+    DeadRoom.scrapes = 0
+    monkeypatch.setattr(webserver, scraper, DeadRoom)
+    rsps, _ = asyncio.run(_serve(*[(provider, 'dead', None)] * 5))
+    assert [rsp.status for rsp in rsps] == [404] * 5
+    assert DeadRoom.scrapes == 1
+    extractor = webserver.processor_maps[provider]['dead']
+    assert not extractor.needs_extraction(None)
+    extractor.last_refresh_time -= extractor.FAIL_COOLDOWN + 1
+    assert extractor.needs_extraction(None)
+
+
+class SlowDouYu(FakeDouYu):
+    def get_real_url(self):
+        time.sleep(0.3)
+        return super().get_real_url()
+
+
+async def _serve_with_cancelled_leader():
+    loop = asyncio.get_running_loop()
+    await webserver.setup_app_ctx(webserver.app, loop)
+    try:
+        leader = asyncio.ensure_future(webserver.serviceWithRate(None, 'douyu', '3', None))
+        await asyncio.sleep(0.05)
+        waiter = asyncio.ensure_future(webserver.serviceWithRate(None, 'douyu', '3', None))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        return await waiter
+    finally:
+        await webserver.close_app_ctx(webserver.app, loop)
+
+
+def test_waiter_survives_cancelled_leader(monkeypatch):
+    monkeypatch.setattr(webserver, 'DouYu', SlowDouYu)
+    rsp = asyncio.run(_serve_with_cancelled_leader())
+    assert rsp.status == 301
+    assert rsp.headers['Location'] == 'http://example.com/live/3.flv'
+
+
+def test_rewrite_prefixes_segment_lines():
+    body = (b'#EXTM3U\r\n'
+            b'#EXT-X-MAP:URI="init.ts"\r\n'
+            b'\r\n'
+            b'#EXTINF:4.000,\r\n'
+            b'seg_1.ts?wsTime=6543\r\n'
+            b'\n'
+            b'seg_2.ts\n')
+    assert webserver._rewrite(body, b'http://cdn/src') == (
+        b'#EXTM3U\r\n'
+        b'#EXT-X-MAP:URI="init.ts"\r\n'
+        b'\r\n'
+        b'#EXTINF:4.000,\r\n'
+        b'http://cdn/src/seg_1.ts?wsTime=6543\r\n'
+        b'\n'
+        b'http://cdn/src/seg_2.ts\n')
@@ -1,12 +1,17 @@
 import argparse
+import asyncio
+import copy
 import logging
-import re
+import queue
+import time
 from abc import ABCMeta, abstractmethod
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from logging import handlers
-from threading import Timer, Lock
+from threading import Lock
+from urllib.parse import quote_plus
 
-import requests
+import aiohttp
+from cachetools import TTLCache
 from sanic import Blueprint
 from sanic import response
 from sanic import Sanic
@@ -19,6 +24,26 @@ from huya import huya
 app = Sanic(__name__)
 blueprint = Blueprint('service')
 
+_UA_HEADERS = {
+    'Content-Type': 'application/x-www-form-urlencoded',
+    'User-Agent': 'Mozilla/5.0 (Linux; Android 5.0; SM-G900P Build/LRX21T) AppleWebKit/537.36 '
+                  '(KHTML, like Gecko) Chrome/75.0.3770.100 Mobile Safari/537.36 '
+}
+
+class DropQueueHandler(handlers.QueueHandler):
+    """QueueHandler which drops records instead of blocking when the queue is full."""
+
+    def prepare(self, record):
+        # the queue never leaves the process, so skip the base class formatting
+        # and leave merging msg with args to the listener's handlers
+        return copy.copy(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
 class Logger(object):
     level_relations = {
         'debug': logging.DEBUG,
@@ -28,52 +53,119 @@ class Logger(object):
         'crit': logging.CRITICAL
     }
 
-    def __init__(self, filename=None, level='info', when='D', backCount=3, fmt='%(asctime)s - %(levelname)s: %(message)s'):
+    def __init__(self, filename=None, level='info', when='D', backCount=3, fmt='%(asctime)s - %(levelname)s: %(message)s', queueSize=10000):
         self.logger = logging.getLogger('real-url-proxy-server')
         format_str = logging.Formatter(fmt)
         self.logger.setLevel(self.level_relations.get(level))
         sh = logging.StreamHandler()
         sh.setFormatter(format_str)
-        self.logger.addHandler(sh)
+        real_handlers = [sh]
 
         if filename is not None:
             th = handlers.TimedRotatingFileHandler(
                 filename=filename, when=when, backupCount=backCount, encoding='utf-8')
             th.setFormatter(format_str)
-            self.logger.addHandler(th)
+            real_handlers.append(th)
+
+        # callers only enqueue, formatting and io happen on the listener thread
+        log_queue = queue.Queue(queueSize)
+        self.logger.addHandler(DropQueueHandler(log_queue))
+        self.listener = handlers.QueueListener(log_queue, *real_handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        self.listener.stop()
 
 log = None
 
 class RealUrlExtractor:
     __metaclass__ = ABCMeta
-    lock = Lock()
+    MAX_REFRESH_INTERVAL = 24 * 3600
+    IDLE_TIMEOUT = 3600
+    FAIL_COOLDOWN = 60
 
     def __init__(self, room, auto_refresh_interval):
         self.room = room
+        self.lock = Lock()
         self.real_url = None
         self.last_valid_real_url = None
         self.auto_refresh_interval = auto_refresh_interval
-        self.last_refresh_time = datetime.min
-        if self.auto_refresh_interval > 0:
-            self.refresh_timer = Timer(self.auto_refresh_interval, self.refresh_real_url)
+        self.last_refresh_time = float('-inf')
+        self._fail_streak = 0
+        self._last_query_time = time.monotonic()
+        self._closed = False
+        self._redirect = None
+        self._inflight = None
+
+    def _refresh_interval(self, failover):
+        if not failover:
+            return self.auto_refresh_interval
+        # back off exponentially on consecutive failures, starting at half the interval,
+        # the exponent is clamped so long failure streaks cannot overflow the float
+        exponent = min(max(self._fail_streak - 1, 0), 16)
+        return min(self.auto_refresh_interval / 2 * 2 ** exponent, self.MAX_REFRESH_INTERVAL)
 
     def reset_refresh_timer(self, failover):
         if self.auto_refresh_interval > 0:
-            self.refresh_timer.cancel()
-            if failover:
-                refresh_interval = self.auto_refresh_interval / 2
-            else:
-                refresh_interval = self.auto_refresh_interval
-            self.refresh_timer = Timer(refresh_interval, self.refresh_real_url)
-            self.refresh_timer.start()
-
-    def refresh_real_url(self):
-        RealUrlExtractor.lock.acquire()
+            refresh_interval = self._refresh_interval(failover)
+            # may be called from an executor thread, the scheduler lives on the loop
+            app.ctx.loop.call_soon_threadsafe(self._schedule_refresh, refresh_interval)
+
+    def _schedule_refresh(self, refresh_interval):
+        self.cancel_refresh_timer()
+        if self._closed:
+            return
+        app.ctx.scheduler[id(self)] = app.ctx.loop.call_later(refresh_interval, self._start_refresh)
+
+    def cancel_refresh_timer(self):
+        handle = app.ctx.scheduler.pop(id(self), None)
+        if handle is not None:
+            handle.cancel()
+
+    def close(self):
+        self._closed = True
+        self.cancel_refresh_timer()
+
+    def _start_refresh(self):
+        app.ctx.scheduler.pop(id(self), None)
+        asyncio.ensure_future(self.refresh_real_url())
+
+    async def refresh_real_url(self):
+        if time.monotonic() - self._last_query_time > self.IDLE_TIMEOUT:
+            # nobody is watching, the next query will extract on demand
+            log.logger.info('skip refreshing idle room: %s', self.room)
+            return
+        if self._inflight is not None:
+            return
+        await self._run_single_flight(self._refresh_real_url)
+
+    def _run_single_flight(self, func, *args):
+        # extraction scrapes the provider with blocking http, keep it off the loop.
+        # the executor future itself is shared, so a cancelled caller cannot end it early
+        future = app.ctx.loop.run_in_executor(None, func, *args)
+        self._inflight = future
+        future.add_done_callback(self._clear_inflight)
+        return future
+
+    def _clear_inflight(self, future):
+        if self._inflight is future:
+            self._inflight = None
+        if not future.cancelled():
+            # mark the exception retrieved, callers awaiting the future still see it
+            future.exception()
+
+    def _refresh_real_url(self):
         try:
-            self._extract_real_url()
-        except:
-            pass
-        RealUrlExtractor.lock.release()
+            self._extract_real_url_once()
+        except Exception as e:
+            log.logger.error("Failed to refresh real url of room %s! Error: %s", self.room, str(e))
+
+    def _extract_real_url_once(self):
+        # callers that queued on the lock behind a finished extraction reuse its result
+        last_refresh_time = self.last_refresh_time
+        with self.lock:
+            if self.last_refresh_time == last_refresh_time:
+                self._extract_real_url()
 
     @abstractmethod
     def _extract_real_url(self):
@@ -84,7 +176,8 @@ class RealUrlExtractor:
         elif self.last_valid_real_url is not None:
             self.real_url = self.last_valid_real_url
 
-        self.last_refresh_time = datetime.now()
+        self._fail_streak = self._fail_streak + 1 if failover else 0
+        self.last_refresh_time = time.monotonic()
         self.reset_refresh_timer(failover)
         if failover:
             log.logger.info('failed to extract real url')
@@ -95,25 +188,76 @@ class RealUrlExtractor:
     def _is_url_valid(self, url):
         return False
 
+    def redirect_headers(self, url):
+        # real_url is stable between refreshes, so build the redirect headers once per url
+        if self._redirect is None or self._redirect[0] != url:
+            location = quote_plus(url, safe=":/%#?&=@[]!$&'()*+,;")
+            self._redirect = (url, {**crosHeaders, 'Location': location})
+        return self._redirect[1]
+
+    def _is_refresh_overdue(self):
+        return self.auto_refresh_interval > 0 and \
+            time.monotonic() - self.last_refresh_time > self.auto_refresh_interval
+
+    def _is_failure_cooled_down(self):
+        # a room without a url is retried at most once per FAIL_COOLDOWN, not on every request
+        return time.monotonic() - self.last_refresh_time > self.FAIL_COOLDOWN
+
+    def needs_extraction(self, bit_rate):
+        return (self.real_url is None and self._is_failure_cooled_down()) or \
+            bit_rate == 'refresh' or self._is_refresh_overdue()
+
+    async def get_real_url_async(self, bit_rate):
+        if not self.needs_extraction(bit_rate):
+            return self.get_real_url(bit_rate)
+        if self._inflight is None:
+            return await asyncio.shield(self._run_single_flight(self.get_real_url, bit_rate))
+        # another caller is already extracting this room, share its result
+        await asyncio.shield(self._inflight)
+        if bit_rate == 'refresh':
+            bit_rate = None
+        if self.needs_extraction(bit_rate):
+            return None
+        return self.get_real_url(bit_rate)
+
+    def _prepare_bit_rate(self, bit_rate):
+        # extract when needed, then map 'refresh' to the default bit rate
+        self._last_query_time = time.monotonic()
+        if self.needs_extraction(bit_rate):
+            self._extract_real_url_once()
+        if bit_rate == 'refresh':
+            bit_rate = None
+        return bit_rate
+
     def get_real_url(self, bit_rate):
-        if self.real_url is None or bit_rate == 'refresh':
-            self._extract_real_url()
+        self._prepare_bit_rate(bit_rate)
+        return self.real_url
 
 class HuYaRealUrlExtractor(RealUrlExtractor):
+    FRESH = 90
+    STALE = 240
+
     def __init__(self, room, auto_refresh_interval):
         super().__init__(room, auto_refresh_interval)
-        self.huya = huya(self.room, 1463993859134, 1)
+        # huya() fetches the room page, defer it to the first extraction
+        self.huya = None
+        self._cdn_infos = []
         self.cdn_index = -1
         self.last_real_urls = None
-        self.last_get_real_url_time = datetime.min
+        self.last_get_real_url_time = float('-inf')
+        self._refreshing = False
 
     def _extract_real_url(self):
-        self.huya.update_live_url_info()
-        cdn_count = len(self.huya.live_url_infos)
+        if self.huya is None:
+            self.huya = huya(self.room, 1463993859134, 1)
+        else:
+            self.huya.update_live_url_info()
+        self._cdn_infos = list(self.huya.live_url_infos.values())
+        cdn_count = len(self._cdn_infos)
         if self.cdn_index >= cdn_count:
             self.cdn_index = 0
         if cdn_count > 0:
-            self.real_url = list(self.huya.live_url_infos.values())[self.cdn_index]['hls_url']
+            self.real_url = self._cdn_infos[self.cdn_index]['hls_url']
         else:
             self.real_url = None
         super()._extract_real_url()
@@ -122,20 +266,24 @@ class HuYaRealUrlExtractor(RealUrlExtractor):
         return url is not None
 
     def get_real_url(self, bit_rate):
-        super().get_real_url(bit_rate)
-
-        if bit_rate == 'refresh':
-            bit_rate = None
+        bit_rate = self._prepare_bit_rate(bit_rate)
 
         if bit_rate == 'switch_cdn':
             self.cdn_index += 1
 
-        if self.last_real_urls is None or (datetime.now() - self.last_get_real_url_time).total_seconds() > 120:
-            urls = self.huya.get_real_url(bit_rate)
-            self.last_real_urls = urls
-            self.last_get_real_url_time = datetime.now()
-        else:
-            urls = self.last_real_urls
+        age = time.monotonic() - self.last_get_real_url_time
+        if self.last_real_urls is None or age >= self.STALE:
+            self._update_real_urls(bit_rate)
+        elif age >= self.FRESH and not self._refreshing:
+            # serve the stale urls and refetch them on the next loop iteration
+            # flag first so a callback running on the loop thread can clear it, undo if scheduling fails
+            self._refreshing = True
+            try:
+                app.ctx.loop.call_soon_threadsafe(self._refresh_real_urls, bit_rate)
+            except:
+                self._refreshing = False
+                raise
+        urls = self.last_real_urls
 
         if len(urls) > 0:
             if self.cdn_index >= len(urls):
@@ -143,156 +291,230 @@ class HuYaRealUrlExtractor(RealUrlExtractor):
             return urls[self.cdn_index]
         return None
 
+    def _update_real_urls(self, bit_rate):
+        self.last_real_urls = self.huya.get_real_url(bit_rate)
+        self.last_get_real_url_time = time.monotonic()
+
+    def _refresh_real_urls(self, bit_rate):
+        try:
+            self._update_real_urls(bit_rate)
+        except Exception as e:
+            log.logger.error("Failed to refresh huya real urls! Error: %s", str(e))
+        finally:
+            self._refreshing = False
+
     def reset_last_get_real_url_time(self):
-        self.last_get_real_url_time = datetime.min
+        self.last_get_real_url_time = float('-inf')
 
     def stream_name(self):
-        return list(self.huya.live_url_infos.values())[self.cdn_index]['stream_name']
+        if not self._cdn_infos:
+            return None
+        return self._cdn_infos[self.cdn_index]['stream_name']
 
     def base_url(self):
-        return list(self.huya.live_url_infos.values())[self.cdn_index]['base_url']
+        if not self._cdn_infos:
+            return None
+        return self._cdn_infos[self.cdn_index]['base_url']
 
 
+_DOUYU_FALLBACK = ('flv', '2000p', '900p')
+
 class DouYuRealUrlExtractor(RealUrlExtractor):
     def _extract_real_url(self):
         try:
             self.real_url = DouYu(self.room).get_real_url()
         except:
-            self.real_url = 'None'
+            self.real_url = None
         super()._extract_real_url()
 
     def _is_url_valid(self, url):
-        return url is not None and url != 'None'
+        return url is not None and isinstance(url, dict)
 
     def get_real_url(self, bit_rate):
-        super().get_real_url(bit_rate)
-
-        if bit_rate == 'refresh':
-            bit_rate = None
+        bit_rate = self._prepare_bit_rate(bit_rate)
 
         if not self._is_url_valid(self.real_url):
             return None
         if bit_rate is None or len(bit_rate) == 0:
-            if 'flv' in self.real_url:
-                return self.real_url['flv']
-            elif '2000p' in self.real_url:
-                return self.real_url['2000p']
-            else:
-                return self.real_url['900p']
-        if bit_rate in self.real_url.keys():
+            for k in _DOUYU_FALLBACK:
+                if k in self.real_url:
+                    return self.real_url[k]
+            return None
+        if bit_rate in self.real_url:
             return self.real_url[bit_rate]
 
+_BILIBILI_FALLBACK = ('hls_url', 'flv_url')
+
 class BilibiliRealUrlExtractor(RealUrlExtractor):
     def _extract_real_url(self):
         try:
             self.real_url = BiliBili(self.room).get_real_url()
         except:
-            self.real_url = 'None'
+            self.real_url = None
         super()._extract_real_url()
 
     def _is_url_valid(self, url):
-        return url is not None and url != 'None'
+        return url is not None and isinstance(url, dict)
 
     def get_real_url(self, bit_rate):
-        super().get_real_url(bit_rate)
-
-        if bit_rate == 'refresh':
-            bit_rate = None
+        bit_rate = self._prepare_bit_rate(bit_rate)
 
         if not self._is_url_valid(self.real_url):
             return None
-        if 'hls_url' in self.real_url:
-            return self.real_url['hls_url']
-        else:
-            return self.real_url['flv_url']
+        for k in _BILIBILI_FALLBACK:
+            if k in self.real_url:
+                return self.real_url[k]
+        return None
 
 crosHeaders={'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Methods': 'GET',
             'Access-Control-Allow-Headers':'Content-Type, Content-Length, Authorization'}
+_NOT_FOUND_BODY = "Not Found".encode("gb2312")
+_NOT_FOUND_HEADERS = {**crosHeaders,
+                      'Content-type': "text/html; charset=gb2312",
+                      'Content-Length': str(len(_NOT_FOUND_BODY))}
 processor_maps = {}
 auto_refresh_interval=7200
+_SHARDS = [Lock() for _ in range(64)]
+# hls playlists roll over every few seconds, a short ttl lets polling players share one fetch
+_M3U8_CACHE = TTLCache(maxsize=2048, ttl=2)
+_M3U8_INFLIGHT = {}
+
+class ExtractorCache(TTLCache):
+    """TTLCache of room extractors which closes extractors as they are evicted."""
+
+    def popitem(self):
+        key, extractor = super().popitem()
+        extractor.close()
+        return key, extractor
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for _, extractor in expired:
+            extractor.close()
+        return expired
+
+def _get_extractor(provider, room, cls):
+    pmap = processor_maps.get(provider)
+    if pmap is None:
+        pmap = processor_maps.setdefault(provider, ExtractorCache(maxsize=1024, ttl=1800))
+    extractor = pmap.get(room)
+    if extractor is None:
+        with _SHARDS[hash(room) & 63]:
+            extractor = pmap.get(room)
+            if extractor is None:
+                new_extractor = cls(room, auto_refresh_interval)
+                extractor = pmap.setdefault(room, new_extractor)
+                if extractor is not new_extractor:
+                    new_extractor.close()
+    # re-insert to restart the idle ttl and refresh lru order
+    pmap[room] = extractor
+    return extractor
+
+def _rewrite(body, prefix):
+    # point segment lines (which may carry a query string) at the cdn base url
+    out = []
+    for line in body.split(b'\n'):
+        if line and not line.startswith(b'#') and b'.ts' in line:
+            line = prefix + b'/' + line
+        out.append(line)
+    return b'\n'.join(out)
+
+async def _fetch_m3u8(request, extractor, real_url):
+    """Returns (status_code, m3u8_content, fetched), fetched is False for the fallback playlist."""
+    try:
+        async with request.app.ctx.http.get(real_url) as resp:
+            status_code = resp.status
+            m3u8_content = await resp.read()
+        m3u8_content = _rewrite(m3u8_content, extractor.base_url().encode('utf-8'))
+        return status_code, m3u8_content, True
+    except Exception:
+        m3u8_content = ('#EXTM3U\n#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=1\n' + real_url).encode('utf-8')
+        extractor.cdn_index += 1
+        return 200, m3u8_content, False
+
+async def _get_m3u8(request, extractor, real_url, key):
+    while True:
+        cached = _M3U8_CACHE.get(key)
+        if cached is not None:
+            return cached
+        # single flight, concurrent misses on the same key wait for the first fetch
+        future = _M3U8_INFLIGHT.get(key)
+        if future is None:
+            break
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+            # the leading request went away before finishing, try again
+    future = asyncio.get_running_loop().create_future()
+    _M3U8_INFLIGHT[key] = future
+    try:
+        status_code, m3u8_content, fetched = await _fetch_m3u8(request, extractor, real_url)
+        result = (status_code, m3u8_content)
+        if fetched and status_code == 200:
+            _M3U8_CACHE[key] = result
+        future.set_result(result)
+        return result
+    finally:
+        del _M3U8_INFLIGHT[key]
+        if not future.done():
+            future.cancel()
+
+@app.before_server_start
+async def setup_app_ctx(app, loop):
+    # app.loop is unusable off the loop thread, extractors schedule through this one
+    app.ctx.loop = loop
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=32))
+    app.ctx.scheduler = {}
+    connector = aiohttp.TCPConnector(limit=200, limit_per_host=64, ttl_dns_cache=300, keepalive_timeout=60)
+    app.ctx.http = aiohttp.ClientSession(connector=connector, headers=_UA_HEADERS,
+                                         timeout=aiohttp.ClientTimeout(total=30))
+
+@app.after_server_stop
+async def close_app_ctx(app, loop):
+    for handle in app.ctx.scheduler.values():
+        handle.cancel()
+    app.ctx.scheduler.clear()
+    await app.ctx.http.close()
+
+async def _handle_redirect(request, extractor, bit_rate):
+    real_url = await extractor.get_real_url_async(bit_rate)
+    if real_url is not None:
+        return response.HTTPResponse(status=301, headers=extractor.redirect_headers(real_url),
+                                     content_type="text/html; charset=utf-8")
+
+async def _handle_huya_m3u8(request, extractor, bit_rate):
+    real_url = await extractor.get_real_url_async(bit_rate)
+    if real_url is not None:
+        key = (extractor.room, extractor.cdn_index, bit_rate)
+        status_code, m3u8_content = await _get_m3u8(request, extractor, real_url, key)
+        if status_code == 403:
+            extractor.reset_last_get_real_url_time()
+        return response.raw(m3u8_content, headers=crosHeaders, status=status_code,
+                            content_type="application/vnd.apple.mpegurl")
+
+_PROVIDERS = {
+    'douyu': (DouYuRealUrlExtractor, _handle_redirect),
+    'bilibili': (BilibiliRealUrlExtractor, _handle_redirect),
+    'huya': (HuYaRealUrlExtractor, _handle_huya_m3u8),
+}
 
 @app.get('/<provider>/<room>/<bit_rate>')
 async def serviceWithRate(request,provider,room,bit_rate):
     log.logger.info('provider: %s, room: %s, bit_rate: %s', provider, room, bit_rate)
-    if provider == 'douyu':
-        if provider not in processor_maps.keys():
-            processor_maps[provider] = {}
-        douyu_processor_map = processor_maps[provider]
-
-        try:
-            if room not in douyu_processor_map.keys():
-                douyu_processor_map[room] = DouYuRealUrlExtractor(room, auto_refresh_interval)
-
-            real_url = douyu_processor_map[room].get_real_url(bit_rate)
-            if real_url is not None:
-                return response.redirect(
-                    to=real_url,
-                    headers=crosHeaders,
-                    status=301
-                )
-
-        except Exception as e:
-            log.logger.error("Failed to extract douyu real url! Error: %s", str(e))
-    elif provider == 'bilibili':
-        if provider not in processor_maps.keys():
-            processor_maps[provider] = {}
-        bilibili_processor_map = processor_maps[provider]
-
+    entry = _PROVIDERS.get(provider)
+    if entry is not None:
+        cls, handler = entry
         try:
-            if room not in bilibili_processor_map.keys():
-                bilibili_processor_map[room] = BilibiliRealUrlExtractor(room, auto_refresh_interval)
-
-            real_url = bilibili_processor_map[room].get_real_url(bit_rate)
-            if real_url is not None:
-                return response.redirect(
-                    to=real_url,
-                    headers=crosHeaders,
-                    status=301
-                )
-        except Exception as e:
-            log.logger.error("Failed to extract bilibili real url! Error: %s", str(e))
-    elif provider == 'huya':
-        if provider not in processor_maps.keys():
-            processor_maps[provider] = {}
-        huya_processor_map = processor_maps[provider]
-
-        try:
-            if room not in huya_processor_map.keys():
-                huya_processor_map[room] = HuYaRealUrlExtractor(room, auto_refresh_interval)
-
-            real_url = huya_processor_map[room].get_real_url(bit_rate)
-            if real_url is not None:
-                status_code = 200
-                try:
-                    header = {
-                        'Content-Type': 'application/x-www-form-urlencoded',
-                        'User-Agent': 'Mozilla/5.0 (Linux; Android 5.0; SM-G900P Build/LRX21T) AppleWebKit/537.36 '
-                                      '(KHTML, like Gecko) Chrome/75.0.3770.100 Mobile Safari/537.36 '
-                    }
-                    resp = requests.get(url=real_url, headers=header, timeout=30)
-                    status_code = resp.status_code
-                    m3u8_content = resp.text
-                    m3u8_content = re.sub(r'(^.*?\.ts)', huya_processor_map[room].base_url() + r'/\1', m3u8_content,
-                                          flags=re.M)
-                except:
-                    m3u8_content = '#EXTM3U\n#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=1\n' + real_url
-                    huya_processor_map[room].cdn_index += 1
-                if status_code == 403:
-                    huya_processor_map[room].reset_last_get_real_url_time()
-                return response.text(body=m3u8_content,headers=crosHeaders.update({
-                    'Content-type': "application/vnd.apple.mpegurl",
-                    'Content-Length': str(len(m3u8_content))
-                }),status=status_code)
-
+            extractor = _get_extractor(provider, room, cls)
+            rsp = await handler(request, extractor, bit_rate)
+            if rsp is not None:
+                return rsp
         except Exception as e:
-            log.logger.error("Failed to proxy huya hls stream! Error: %s", str(e))
-    rsp = "Not Found"
-    rsp = rsp.encode("gb2312")
-    return response.html(body=rsp,headers=crosHeaders.update({
-                    'Content-type': "text/html; charset=gb2312",
-                    'Content-Length': str(len(rsp))
-                }),status=404)
+            log.logger.error("Failed to serve %s room %s! Error: %s", provider, room, str(e))
+    return response.raw(_NOT_FOUND_BODY, headers=_NOT_FOUND_HEADERS, status=404, content_type=None)
 
 @app.get('/<provider>/<roomId>')
 async def service(request,provider,roomId):
@@ -319,3 +541,4 @@ if __name__ == '__main__':
     app.run(host="0.0.0.0",port=port , debug=True)
 
     log.logger.info('Server stopped.')
+    log.stop()